@@ -2,6 +2,7 @@
 import pickle
 import sys
 import os
+import re
 import struct
 import getpass
 from hashlib import sha256
@@ -28,6 +29,33 @@ except ImportError as e:
     sys.exit(1)
 
 BLOCK_SIZE = 512
+HSB1_SIGNATURE = b'\x00\x01\x44\x57'
+
+# SCSI CDB templates, mutable fields are patched on a per-call copy
+CDB_HANDY_STORE = b'\xD8\x00\x00\x00\x00\x01\x00\x00\x01\x00'
+CDB_ENCRYPTION_STATUS = b'\xC0\x45\x00\x00\x00\x00\x00\x00\x30\x00'
+CDB_UNLOCK = b'\xC1\xE1\x00\x00\x00\x00\x00\x00\x28\x00'
+CDB_CHANGE_PASSWORD = b'\xC1\xE2\x00\x00\x00\x00\x00\x00\x48\x00'
+CDB_SECURE_ERASE = b'\xC1\xE3\x00\x00\x00\x00\x00\x00\x08\x00'
+
+SEC_STATUS = {
+    0x00: "No lock",
+    0x01: "Locked",
+    0x02: "Unlocked",
+    0x06: "Locked, unlock blocked",
+    0x07: "No keys"
+}
+
+CIPHERS = {
+    0x10: "AES_128_ECB",
+    0x12: "AES_128_CBC",
+    0x18: "AES_128_XTS",
+    0x20: "AES_256_ECB",
+    0x22: "AES_256_CBC",
+    0x28: "AES_256_XTS",
+    0x30: "Full Disk Encryption"
+}
+
 dev = None
 
 
@@ -118,41 +146,20 @@ def check_root_user():
         sys.exit(1)
 
 
+def check_sha256_backend():
+    '''Warn if SHA-256 is not provided by OpenSSL (no SHA-NI, slow password hashing)'''
+    if sha256.__module__ != "_hashlib":
+        fail("Python's hashlib is not linked to OpenSSL, password hashing will be much slower.")
+
+
 def sec_status_to_str(security_status):
     '''Convert an integer to his human-readable secure status'''
-    status = {
-        0x00: "No lock",
-        0x01: "Locked",
-        0x02: "Unlocked",
-        0x06: "Locked, unlock blocked",
-        0x07: "No keys"
-    }
-    if security_status in status.keys():
-        return status[security_status]
-    else:
-        return "unknown"
+    return SEC_STATUS.get(security_status, "unknown")
 
 
 def cipher_id_to_str(id):
     '''Convert an integer to his human-readable cipher algorithm'''
-    ciphers = {
-        0x10: "AES_128_ECB",
-        0x12: "AES_128_CBC",
-        0x18: "AES_128_XTS",
-        0x20: "AES_256_ECB",
-        0x22: "AES_256_CBC",
-        0x28: "AES_256_XTS",
-        0x30: "Full Disk Encryption"
-    }
-    if id in ciphers.keys():
-        return ciphers[id]
-    else:
-        return "unknown"
-
-
-def _scsi_pack_cdb(cdb):
-    '''Transform "cdb" in char[]'''
-    return struct.pack('{0}B'.format(len(cdb)), *cdb)
+    return CIPHERS.get(id, "unknown")
 
 
 def htonl(num):
@@ -160,29 +167,18 @@ def htonl(num):
     return struct.pack('!I', num)
 
 
-def htons(num):
-    '''Convert int from  host byte order to network byte order'''
-    return struct.pack('!H', num)
-
-
 def read_handy_store(page):
     '''Call the device and get the selected block of Handy Store.'''
-    cdb = [0xD8, 0x00, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x01, 0x00]
-    i = 2
-    for c in htonl(page):
-        cdb[i] = c
-        i += 1
-    return py3_sg.read_as_bin_str(dev, _scsi_pack_cdb(cdb), BLOCK_SIZE)
+    cdb = bytearray(CDB_HANDY_STORE)
+    cdb[2:6] = htonl(page)
+    return py3_sg.read_as_bin_str(dev, bytes(cdb), BLOCK_SIZE)
 
 
 def hsb_checksum(data):
     '''Calculate checksum on the returned data'''
-    c = 0
-    for i in range(510):
-        c = c + data[i]
+    c = sum(memoryview(data)[:510])
     c = c + data[0]  # Some WD Utils count data[0] twice, some other not ...
-    r = (c * -1) & 0xFF
-    return hex(r)
+    return (c * -1) & 0xFF
 
 
 def get_encryption_status():
@@ -205,8 +201,7 @@ def get_encryption_status():
             0x30 =>	Full Disk Encryption
         KeyResetEnabler (4 bytes that change every time)
     '''
-    cdb = [0xC0, 0x45, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x30, 0x00]
-    data = py3_sg.read_as_bin_str(dev, _scsi_pack_cdb(cdb), BLOCK_SIZE)
+    data = py3_sg.read_as_bin_str(dev, CDB_ENCRYPTION_STATUS, BLOCK_SIZE)
     if data[0] != 0x45:
         fail(f"Wrong encryption status signature {data[0]:#x}")
         sys.exit(1)
@@ -222,17 +217,15 @@ def read_HSB1():
         Salt - salt used in password generation
         Hint - hint of the password if used. TODO.
     '''
-    signature = [0x00, 0x01, 0x44, 0x57]
     sector_data = read_handy_store(1)
     # Check if retrieved Checksum is correct
-    if hsb_checksum(sector_data) != hex(sector_data[511]):
+    if hsb_checksum(sector_data) != sector_data[511]:
         fail("Wrong HSB1 checksum")
         sys.exit(1)
     # Check if retrieved Signature is correct
-    for i in range(0, 4):
-        if signature[i] != sector_data[i]:
-            fail("Wrong HSB1 signature.")
-            sys.exit(1)
+    if sector_data[:4] != HSB1_SIGNATURE:
+        fail("Wrong HSB1 signature.")
+        sys.exit(1)
 
     iteration = struct.unpack_from("<I", sector_data[8:])
     salt = sector_data[12:20] + bytes([0x00, 0x00])
@@ -242,19 +235,25 @@ def read_HSB1():
 
 def mk_password_block(passwd, iteration, salt):
     '''Perform password hashing with requirements obtained from the device'''
-    clean_salt = ""
-    for i in range(int(len(salt)/2)):
-        if salt[2*i] == salt[2*i+1] == 0x00:
-            break
-        clean_salt = clean_salt + chr(salt[2*i])
+    # Salt is UTF-16LE terminated by an aligned 00 00 pair
+    end = salt.find(b'\x00\x00')
+    while end % 2 and end != -1:
+        end = salt.find(b'\x00\x00', end + 1)
+    if end == -1:
+        end = len(salt) - len(salt) % 2
+    clean_salt = salt[:end:2].decode("latin-1")
 
-    password = clean_salt + passwd
-    password = password.encode("utf-16")[2:]
+    password = (clean_salt + passwd).encode("utf-16-le")
 
-    for _ in range(iteration):
-        password = sha256(password).digest()
+    return _sha256_chain(password, iteration)
 
-    return password
+
+def _sha256_chain(data, iteration):
+    '''Hash "data" with SHA-256 "iteration" times, feeding back each digest'''
+    hash_func = sha256
+    for _ in range(iteration):
+        data = hash_func(data).digest()
+    return data
 
 
 def become_user():
@@ -305,7 +304,7 @@ def seve_password_to_secret_service(device_name, password):
 
 def unlock(device, save_passwd, unlock_with_saved_passwd):
     '''Unlock the device'''
-    cdb = [0xC1, 0xE1, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x28, 0x00]
+    cdb = bytearray(CDB_UNLOCK)
     sec_status, cipher_id, _ = get_encryption_status()
 
     # Device should be in the correct state
@@ -326,6 +325,9 @@ def unlock(device, save_passwd, unlock_with_saved_passwd):
         fail(f"Unsupported cipher {cipher_id:#x}")
         sys.exit(1)
 
+    if unlock_with_saved_passwd or save_passwd:
+        device_name = get_device_info(device)[3]
+
     # Get password from user
     if not unlock_with_saved_passwd:
         question("Insert password to Unlock the device:")
@@ -334,20 +336,20 @@ def unlock(device, save_passwd, unlock_with_saved_passwd):
         pwd_hashed = mk_password_block(passwd, iteration, salt)
     else:
         success("Unlock use saved password")
-        pwd_hashed = get_password_from_secret_service(get_device_info(device)[3])
+        pwd_hashed = get_password_from_secret_service(device_name)
 
     if save_passwd:
-        seve_password_to_secret_service(get_device_info(device)[3], pwd_hashed)
+        seve_password_to_secret_service(device_name, pwd_hashed)
 
-    pw_block = [0x45, 0x00, 0x00, 0x00, 0x00, 0x00]
-    for c in htons(pwblen):
-        pw_block.append(c)
+    pw_block = bytearray(8)
+    pw_block[0] = 0x45
+    struct.pack_into('!H', pw_block, 6, pwblen)
+    pw_block += pwd_hashed
 
     cdb[8] = pwblen + 8
 
     try:
-        py3_sg.write(dev, _scsi_pack_cdb(cdb),
-                    _scsi_pack_cdb(pw_block) + pwd_hashed)
+        py3_sg.write(dev, bytes(cdb), bytes(pw_block))
         success("Device unlocked.")
     except:
         fail("Wrong password? Or something bad is happened. Try again")
@@ -362,7 +364,7 @@ def change_password():
 
     DEVICE HAS TO BE UNLOCKED TO PERFORM THIS OPERATION.
     '''
-    cdb = [0xC1, 0xE2, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x48, 0x00]
+    cdb = bytearray(CDB_CHANGE_PASSWORD)
     sec_status, cipher_id, _ = get_encryption_status()
     if sec_status not in [0x02, 0x00]:
         fail("Device has to be unlocked or without encryption to perform this operation")
@@ -392,33 +394,29 @@ def change_password():
         sys.exit(1)
 
     iteration, salt, _ = read_HSB1()
-    pw_block = [0x45, 0x00, 0x00, 0x00, 0x00, 0x00]
-    for c in htons(pwblen):
-        pw_block.append(c)
+    pw_block = bytearray(8)
+    pw_block[0] = 0x45
+    struct.pack_into('!H', pw_block, 6, pwblen)
 
     if (len(old_passwd) > 0):
         old_passwd_hashed = mk_password_block(old_passwd, iteration, salt)
         pw_block[3] = pw_block[3] | 0x10
     else:
-        old_passwd_hashed = ""
-        for _ in range(32):
-            old_passwd_hashed = old_passwd_hashed + chr(0x00)
+        old_passwd_hashed = b'\x00' * 32
 
     if (len(new_passwd) > 0):
         new_passwd_hashed = mk_password_block(new_passwd, iteration, salt)
         pw_block[3] = pw_block[3] | 0x01
     else:
-        new_passwd_hashed = ""
-        for _ in range(32):
-            new_passwd_hashed = new_passwd_hashed + chr(0x00)
+        new_passwd_hashed = b'\x00' * 32
 
     if pw_block[3] & 0x11 == 0x11:
         pw_block[3] = pw_block[3] & 0xEE
 
     cdb[8] = 8 + 2 * pwblen
     try:
-        py3_sg.write(dev, _scsi_pack_cdb(cdb), _scsi_pack_cdb(
-            pw_block) + old_passwd_hashed + new_passwd_hashed)
+        py3_sg.write(dev, bytes(cdb), bytes(
+            pw_block + old_passwd_hashed + new_passwd_hashed))
         success("Password changed.")
     except:
         fail("Error changing password: Wrong password or something bad is happened.")
@@ -430,13 +428,16 @@ def secure_erase(cipher_id=0):
     Change the internal key used for encryption, every data on the device would be permanently unaccessible.
     Device forgets even the partition table so you have to make a new one.
     '''
-    cdb = [0xC1, 0xE3, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x08, 0x00]
-    _, current_cipher_id, key_reset = get_encryption_status()
-
+    cdb = bytearray(CDB_SECURE_ERASE)
+    # key_reset needs to be retrieved immediately before the reset request.
+    # Only local work happens between this query and the write, so the same
+    # response can provide both the current cipher and key_reset.
     if cipher_id == 0:
-        cipher_id = current_cipher_id
+        _, cipher_id, key_reset = get_encryption_status()
+    else:
+        key_reset = None
 
-    pw_block = [0x45, 0x00, 0x00, 0x00, 0x30, 0x00, 0x00, 0x00]
+    pw_block = bytearray(b'\x45\x00\x00\x00\x30\x00\x00\x00')
 
     if cipher_id in [0x10, 0x12, 0x18]:
         pwblen = 16
@@ -454,18 +455,14 @@ def secure_erase(cipher_id=0):
     # Set the actual length of pw_block (8 bytes + pwblen pseudorandom data)
     cdb[8] = pwblen + 8
     # Fill pw_block with random data
-    for rand_byte in os.urandom(pwblen):
-        pw_block.append(rand_byte)
+    pw_block += os.urandom(pwblen)
 
-    # key_reset needs to be retrieved immediately before the reset request
-    key_reset = get_encryption_status()[2]
-    i = 2
-    for c in key_reset:
-        cdb[i] = c
-        i += 1
+    if key_reset is None:
+        key_reset = get_encryption_status()[2]
+    cdb[2:6] = key_reset
 
     try:
-        py3_sg.write(dev, _scsi_pack_cdb(cdb), _scsi_pack_cdb(pw_block))
+        py3_sg.write(dev, bytes(cdb), bytes(pw_block))
         success(
             "Device erased. You need to create a new partition on the device (Hint: fdisk and mkfs)")
     except:
@@ -473,6 +470,11 @@ def secure_erase(cipher_id=0):
         pass
 
 
+def lsscsi():
+    '''Return the lines of "lsscsi -d" output'''
+    return subprocess.check_output(["lsscsi", "-d"]).decode().splitlines()
+
+
 def get_device_info(device=None):
     '''
     Get device info through "lsscsi" command
@@ -486,32 +488,19 @@ def get_device_info(device=None):
     if device == None:
         grep_string = "Passport"
     else:
-        grep_string = str(device, 'utf-8')
-
-    dev_reg = r'"\/([a-zA-Z]+)\/([a-zA-Z0-9]+)"'
-    complete_path = subprocess.Popen(
-        f"lsscsi | grep {grep_string} | grep -oP {dev_reg}",
-        shell=True,
-        stdout=subprocess.PIPE
-    ).stdout.read().rstrip()
-
-    relative_path = subprocess.Popen(
-        f"lsscsi | grep {grep_string} | grep -oP {dev_reg} | cut -d '/' -f 3",
-        shell=True,
-        stdout=subprocess.PIPE
-    ).stdout.read().rstrip()
-
-    host_number = subprocess.Popen(
-        f"lsscsi -d | grep {grep_string} | cut -d ':' -f 1 | cut -d '[' -f 2",
-        shell=True,
-        stdout=subprocess.PIPE
-    ).stdout.read().rstrip()
-
-    dev_name = subprocess.Popen(
-        f"sudo lsscsi | grep {grep_string} | cut -d ']' -f 2 | cut -d '/' -f 1 | tr -s ' ' | sed -e 's/^[[:space:]]*//'",
-        shell=True,
-        stdout=subprocess.PIPE
-    ).stdout.read().rstrip()
+        grep_string = os.fsdecode(device)
+
+    for line in lsscsi():
+        if grep_string in line:
+            break
+    else:
+        return [b'', b'', b'', b'']
+
+    dev_path = re.search(r'/([a-zA-Z]+)/([a-zA-Z0-9]+)', line)
+    complete_path = dev_path.group(0).encode()
+    relative_path = dev_path.group(2).encode()
+    host_number = line.split(':', 1)[0].lstrip('[').encode()
+    dev_name = ' '.join(line.split(']', 1)[1].split('/', 1)[0].split()).encode()
 
     return [complete_path, relative_path, host_number, dev_name]
 
@@ -527,15 +516,11 @@ def enable_mount(device):
         info = get_device_info(device)
         rp = str(info[1], 'utf-8')
         hn = str(info[2], 'utf-8')
-        subprocess.Popen(
-            f"echo 1 > /sys/block/{rp}/device/delete",
-            shell=True
-        )
+        with open(f"/sys/block/{rp}/device/delete", "w") as f:
+            f.write("1")
 
-        subprocess.Popen(
-            f"echo \"- - -\" > /sys/class/scsi_host/host{hn}/scan",
-            shell=True
-        )
+        with open(f"/sys/class/scsi_host/host{hn}/scan", "w") as f:
+            f.write("- - -")
 
         success(
             "Now depending on your system you can mount your device or it will be automatically mounted.")
@@ -548,12 +533,7 @@ def get_device(device):
         return device
     else:
         # Get occurrences of "Passport" devices
-        p = subprocess.Popen(
-            "lsscsi | grep Passport | wc -l",
-            shell=True,
-            stdout=subprocess.PIPE)
-
-        if int(p.stdout.read().rstrip()) > 1:
+        if sum("Passport" in line for line in lsscsi()) > 1:
             fail("Multiple occurrences of 'My Passport' detected.")
             fail("You should specify a device manually (with -d option).")
             sys.exit(1)
@@ -583,6 +563,9 @@ def main():
         success("Device state")
         print(f"\tSecurity status: {sec_status_to_str(status)}")
         print(f"\tEncryption type: {cipher_id_to_str(cipher_id)}")
+    if args.unlock or args.change_passwd:
+        check_sha256_backend()
+
     if args.unlock:
         unlock(DEVICE, args.save_passwd, False)
 